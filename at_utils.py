@@ -1,23 +1,25 @@
 """
 Africa's Talking API utilities for SMS and USSD
 """
-import os
-import requests
+import httpx
+from functools import lru_cache
 from typing import Optional
-from dotenv import load_dotenv
+from config import get_settings
+from http_client import get_client
 
-load_dotenv()
-
-# Africa's Talking credentials
-AT_USERNAME = os.getenv("AT_USERNAME")
-AT_API_KEY = os.getenv("AT_API_KEY")
+# Africa's Talking credentials are read lazily via config.get_settings()
 AT_SMS_URL = "https://api.africastalking.com/version1/messaging"
 
+# Separators stripped from phone numbers in one pass
+_PHONE_STRIP = str.maketrans("", "", " -\t")
+
 
+@lru_cache(maxsize=4096)
 def format_phone_number(phone: str) -> str:
     """
     Format phone number for Africa's Talking API
     Ensures phone number has country code (e.g., +254 for Kenya)
+    Results are memoized since the same vendor/customer numbers recur.
     
     Args:
         phone: Phone number (with or without country code)
@@ -26,18 +28,19 @@ def format_phone_number(phone: str) -> str:
         str: Formatted phone number with country code
     """
     # Remove any whitespace
-    phone = phone.strip().replace(" ", "").replace("-", "")
+    phone = phone.strip().translate(_PHONE_STRIP)
+    lead = phone[:1]
     
     # If already has +, return as is
-    if phone.startswith("+"):
+    if lead == "+":
         return phone
     
     # If starts with 0, replace with country code (Kenya: +254)
-    if phone.startswith("0"):
+    if lead == "0":
         return "+254" + phone[1:]
     
     # If starts with country code without +, add +
-    if phone.startswith("254"):
+    if phone[:3] == "254":
         return "+" + phone
     
     # Default: assume it's a local number, add Kenya country code
@@ -45,9 +48,9 @@ def format_phone_number(phone: str) -> str:
     return "+254" + phone
 
 
-def send_sms(phone_number: str, message: str) -> dict:
+async def send_sms_async(phone_number: str, message: str) -> dict:
     """
-    Send SMS via Africa's Talking API
+    Send SMS via Africa's Talking API without blocking the event loop
     
     Args:
         phone_number: Recipient phone number (will be formatted automatically)
@@ -56,43 +59,42 @@ def send_sms(phone_number: str, message: str) -> dict:
     Returns:
         dict: API response
     """
-    if not AT_USERNAME or not AT_API_KEY:
+    settings = get_settings()
+    if not settings.at_username or not settings.at_api_key:
         return {
             "error": "Africa's Talking credentials not configured",
             "success": False
         }
 
-    # Format phone number
     formatted_phone = format_phone_number(phone_number)
 
     headers = {
-        "ApiKey": AT_API_KEY,
-        "Content-Type": "application/x-www-form-urlencoded",
+        "ApiKey": settings.at_api_key,
         "Accept": "application/json"
     }
 
     data = {
-        "username": AT_USERNAME,
+        "username": settings.at_username,
         "to": formatted_phone,
         "message": message
     }
 
     try:
-        response = requests.post(AT_SMS_URL, headers=headers, data=data)
+        response = await get_client().post(AT_SMS_URL, headers=headers, data=data)
         response.raise_for_status()
-        
+
         return {
             "success": True,
             "response": response.json()
         }
-    except requests.exceptions.RequestException as e:
+    except httpx.HTTPError as e:
         return {
             "success": False,
             "error": str(e)
         }
 
 
-def send_sale_notification(customer_phone: str, amount: float, points_earned: float) -> dict:
+async def send_sale_notification(customer_phone: str, amount: float, points_earned: float) -> dict:
     """
     Send SMS notification to customer after successful sale
     
@@ -109,7 +111,7 @@ def send_sale_notification(customer_phone: str, amount: float, points_earned: fl
         f"You earned {points_earned:.2f} Kula Points. Thank you!"
     )
     
-    return send_sms(customer_phone, message)
+    return await send_sms_async(customer_phone, message)
 
 
 def repay_loan(customer_phone: str, loan_amount: float) -> dict:
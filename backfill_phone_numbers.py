@@ -0,0 +1,76 @@
+"""
+One-off migration: rewrite stored customer phone numbers to +254 form
+
+The USSD, SMS and WhatsApp handlers look customers up by the canonical
+number from at_utils.format_phone_number. Rows stored as typed
+("0712...", "254712...") must be rewritten once before deploying that
+change, or those customers stop matching their points and history.
+
+Usage:
+    python backfill_phone_numbers.py
+
+Uses DATABASE_URL (see database.py) with the matching sync driver.
+"""
+from sqlalchemy import create_engine
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import Session
+
+from at_utils import format_phone_number
+from database import DATABASE_URL
+from models import Customer, Transaction
+
+
+def backfill_canonical_phones(db: Session) -> int:
+    """
+    Rewrite customer and transaction phone numbers to canonical form
+    Customers stored under several spellings of one number are merged:
+    points are summed and the highest credit limit is kept. Safe to re-run.
+
+    Args:
+        db: Database session
+
+    Returns:
+        int: Number of customer rows rewritten or merged
+    """
+    changed = 0
+    customers = db.query(Customer).all()
+    by_phone = {customer.phone_number: customer for customer in customers}
+
+    for customer in customers:
+        canonical = format_phone_number(customer.phone_number)
+        if canonical == customer.phone_number:
+            continue
+        target = by_phone.get(canonical)
+        if target is None:
+            customer.phone_number = canonical
+            by_phone[canonical] = customer
+        else:
+            target.kula_points += customer.kula_points
+            target.credit_limit = max(target.credit_limit, customer.credit_limit)
+            db.delete(customer)
+        changed += 1
+
+    # Point each raw spelling's transactions at the canonical number
+    raw_phones = [phone for (phone,) in db.query(Transaction.customer_phone).distinct() if phone]
+    for phone in raw_phones:
+        canonical = format_phone_number(phone)
+        if canonical != phone:
+            db.query(Transaction).filter(Transaction.customer_phone == phone).update(
+                {Transaction.customer_phone: canonical}, synchronize_session=False
+            )
+
+    db.commit()
+    return changed
+
+
+def main() -> None:
+    # The app uses async drivers (aiosqlite/asyncpg); this script runs sync
+    url = make_url(DATABASE_URL)
+    engine = create_engine(url.set(drivername=url.get_backend_name()))
+    with Session(engine) as db:
+        changed = backfill_canonical_phones(db)
+    print(f"Canonicalised {changed} customer phone number(s)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,28 @@
+"""
+Lazily loaded configuration for KulaPay
+"""
+import os
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Optional
+from dotenv import load_dotenv
+
+
+@dataclass(frozen=True)
+class Settings:
+    """Africa's Talking credentials"""
+    at_username: Optional[str]
+    at_api_key: Optional[str]
+
+
+@lru_cache(maxsize=1)
+def get_settings() -> Settings:
+    """
+    Read .env and the environment on first use and cache the result
+    Call get_settings.cache_clear() to pick up changed environment (e.g. in tests).
+    """
+    load_dotenv()
+    return Settings(
+        at_username=os.getenv("AT_USERNAME"),
+        at_api_key=os.getenv("AT_API_KEY"),
+    )
@@ -4,12 +4,12 @@ Async database configuration and session management for KulaPay (SQLModel).
 from __future__ import annotations
 
 import os
+from typing import AsyncGenerator
 
 from dotenv import load_dotenv
 from sqlmodel import SQLModel
 from sqlmodel.ext.asyncio.session import AsyncSession
-from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.asyncio import AsyncEngine, async_sessionmaker, create_async_engine
 
 load_dotenv()
 
@@ -17,21 +17,48 @@ load_dotenv()
 # Use SQLite by default; override with DATABASE_URL (e.g. postgres+asyncpg://...)
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite+aiosqlite:///./kulapay.db")
 
+# Connection pool tuning (ignored for SQLite)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "20"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "40"))
+DB_POOL_TIMEOUT = int(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "3600"))
 
-engine: AsyncEngine = create_async_engine(
-    DATABASE_URL,
-    echo=False,
-    future=True,
-)
 
-AsyncSessionLocal = sessionmaker(
-    bind=engine,
+def _engine_options(url: str) -> dict:
+    """
+    Build create_async_engine keyword arguments for the given database URL.
+    """
+    options: dict = {"echo": False, "future": True}
+    if url.startswith("sqlite"):
+        # Keep SQLAlchemy's default SQLite pooling
+        return options
+
+    options.update(
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+        pool_recycle=DB_POOL_RECYCLE,
+        pool_pre_ping=True,
+    )
+    if "+asyncpg" in url:
+        options["connect_args"] = {
+            "server_settings": {"application_name": "kulapay", "jit": "off"},
+            "command_timeout": 60,
+        }
+    return options
+
+
+engine: AsyncEngine = create_async_engine(DATABASE_URL, **_engine_options(DATABASE_URL))
+
+AsyncSessionLocal = async_sessionmaker(
+    engine,
     class_=AsyncSession,
     expire_on_commit=False,
+    autoflush=False,
 )
 
 
-async def get_session() -> AsyncSession:
+async def get_session() -> AsyncGenerator[AsyncSession, None]:
     """
     FastAPI dependency to provide an async database session.
     """
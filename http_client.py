@@ -0,0 +1,41 @@
+"""
+Shared async HTTP client for outbound calls to Africa's Talking
+One keep-alive (HTTP/2) pool serves SMS, WhatsApp and payments traffic.
+"""
+from typing import Optional
+
+import httpx
+
+# Bounded timeouts so a slow API can't exhaust the connection pool
+HTTP_TIMEOUT = httpx.Timeout(10.0, connect=3.05)
+HTTP_LIMITS = httpx.Limits(max_connections=64, max_keepalive_connections=32)
+HTTP_CONNECT_RETRIES = 2
+
+_client: Optional[httpx.AsyncClient] = None
+
+
+def get_client() -> httpx.AsyncClient:
+    """
+    Return the process-wide AsyncClient, creating it on first use
+    """
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            transport=httpx.AsyncHTTPTransport(
+                http2=True,
+                limits=HTTP_LIMITS,
+                retries=HTTP_CONNECT_RETRIES,
+            ),
+            timeout=HTTP_TIMEOUT,
+        )
+    return _client
+
+
+async def aclose_client() -> None:
+    """
+    Close the shared client (call on application shutdown)
+    """
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
@@ -5,22 +5,98 @@ from __future__ import annotations
 
 from datetime import datetime, date, time
 from random import choice, randint
-from typing import Optional
+from typing import Final, Optional
 
-from fastapi import Depends, FastAPI, Form, HTTPException
-from fastapi.responses import PlainTextResponse
+from cachetools import TTLCache
+from fastapi import Depends, FastAPI, Form, HTTPException, Query
+from fastapi.responses import ORJSONResponse, PlainTextResponse
+from sqlalchemy import func, insert
 from sqlmodel import select
 
 from database import get_session, init_db
-from models import Transaction, Vendor
+from http_client import aclose_client, get_client
+from models import Transaction, TransactionType, Vendor
+
+app = FastAPI(
+    title="KulaPay API",
+    version="2.0.0",
+    default_response_class=ORJSONResponse,
+)
+
+
+# Static USSD screens
+WELCOME: Final[str] = (
+    "CON Welcome to KulaPay Vendor!\n"
+    "Enter your PIN, or your Full Name to start selling:"
+)
+ASK_BIZ: Final[str] = "CON Great. What is your Business Name?\n0. Back\n00. Home"
+ASK_PIN: Final[str] = "CON Set a 4-digit PIN to secure your wallet:\n0. Back\n00. Home"
+
+HOME_MENU: Final[str] = (
+    "CON Home\n"
+    "1. Record New Sale\n"
+    "2. View Today's Stats\n"
+    "3. My Wallet\n"
+    "0. Logout\n"
+    "00. Home"
+)
+
+RECORD_SALE_ASK_NAME: Final[str] = "CON Enter Customer Name:\n0. Back\n00. Home"
+RECORD_SALE_ASK_PHONE: Final[str] = "CON Enter Customer Phone:\n0. Back\n00. Home"
+RECORD_SALE_ASK_AMOUNT: Final[str] = "CON Enter Amount (KES):\n0. Back\n00. Home"
+RECORD_SALE_BAD_AMOUNT: Final[str] = "CON Invalid amount. Enter Amount (KES):\n0. Back\n00. Home"
+RECORD_SALE_ASK_FOOD: Final[str] = "CON What food was ordered?:\n0. Back\n00. Home"
+RECORD_SALE_OK: Final[str] = "CON Order successful.\n0. Back\n00. Home"
+
+
+# Vendor rows rarely change; cache them per process with bounded staleness
+_vendor_cache: TTLCache[str, Vendor] = TTLCache(maxsize=10_000, ttl=60)
+
+
+async def get_vendor_cached(session, phone_number: str) -> Optional[Vendor]:
+    """
+    Look up a vendor by phone number, serving repeat lookups from a TTL cache.
+    Unknown numbers are not cached so KYC sign-up is picked up immediately.
+    """
+    vendor = _vendor_cache.get(phone_number)
+    if vendor is not None:
+        return vendor
+
+    result = await session.exec(select(Vendor).where(Vendor.phone_number == phone_number))
+    vendor = result.first()
+    if vendor is not None:
+        _vendor_cache[phone_number] = vendor
+    return vendor
+
+
+# (today, start of day, end of day) in UTC, rebuilt when the date rolls over
+_DAY_CACHE: Optional[tuple[date, datetime, datetime]] = None
 
-app = FastAPI(title="KulaPay API", version="2.0.0")
+
+def _today_window() -> tuple[date, datetime, datetime]:
+    """Return today's UTC date and its [start, end] datetime bounds."""
+    global _DAY_CACHE
+    today = datetime.utcnow().date()
+    if _DAY_CACHE is None or _DAY_CACHE[0] != today:
+        _DAY_CACHE = (
+            today,
+            datetime.combine(today, time.min),
+            datetime.combine(today, time.max),
+        )
+    return _DAY_CACHE
 
 
 @app.on_event("startup")
 async def on_startup() -> None:
-    """Initialize database tables on application startup."""
+    """Initialize database tables and the shared HTTP client on startup."""
     await init_db()
+    get_client()
+
+
+@app.on_event("shutdown")
+async def on_shutdown() -> None:
+    """Release pooled outbound HTTP connections."""
+    await aclose_client()
 
 
 @app.get("/")
@@ -37,16 +113,46 @@ async def health_check():
     return {"status": "healthy"}
 
 
-def home_menu(vendor: Vendor) -> str:
-    """Main dashboard menu after successful PIN."""
-    return (
-        "CON Home\n"
-        "1. Record New Sale\n"
-        "2. View Today's Stats\n"
-        "3. My Wallet\n"
-        "0. Logout\n"
-        "00. Home"
+@app.get("/transactions")
+async def list_transactions(
+    cursor: Optional[int] = None,
+    limit: int = Query(100, ge=1, le=100),
+    session=Depends(get_session),
+):
+    """
+    List transactions newest-first (for testing).
+    Uses keyset pagination: pass the returned next_cursor as `cursor`
+    to fetch the following page.
+    """
+    stmt = (
+        select(
+            Transaction.id,
+            Transaction.vendor_id,
+            Transaction.amount,
+            Transaction.transaction_type,
+            Transaction.created_at,
+        )
+        .order_by(Transaction.id.desc())
+        .limit(limit)
     )
+    if cursor is not None:
+        stmt = stmt.where(Transaction.id < cursor)
+
+    rows = (await session.exec(stmt)).all()
+
+    return {
+        "transactions": [
+            {
+                "id": row.id,
+                "vendor_id": row.vendor_id,
+                "amount": row.amount,
+                "transaction_type": row.transaction_type,
+                "created_at": row.created_at,
+            }
+            for row in rows
+        ],
+        "next_cursor": rows[-1].id if len(rows) == limit else None,
+    }
 
 
 @app.post("/debug/seed-today-transactions")
@@ -60,29 +166,26 @@ async def seed_today_transactions(
     This is for local testing of the USSD "Today's Stats" screen.
     """
     # Find vendor
-    result = await session.exec(
-        select(Vendor).where(Vendor.phone_number == phone_number)
-    )
-    vendor = result.first()
+    vendor = await get_vendor_cached(session, phone_number)
     if not vendor:
         raise HTTPException(status_code=404, detail="Vendor not found")
 
     # Kenyan-style random sale amounts (KES)
     possible_amounts = [50, 80, 100, 150, 200, 250, 300]
 
-    # Create transactions timestamped for "now" (today)
-    created = []
-    for _ in range(max(1, count)):
-        amount = float(choice(possible_amounts))
-        tx = Transaction(
-            vendor_id=vendor.id,
-            amount=amount,
-            transaction_type="SALE",
-            created_at=datetime.utcnow(),
-        )
-        session.add(tx)
-        created.append(amount)
-
+    # Create transactions timestamped for "now" (today) in one bulk INSERT
+    now = datetime.utcnow()
+    created = [float(choice(possible_amounts)) for _ in range(max(1, count))]
+    rows = [
+        {
+            "vendor_id": vendor.id,
+            "amount": amount,
+            "transaction_type": TransactionType.SALE,
+            "created_at": now,
+        }
+        for amount in created
+    ]
+    await session.exec(insert(Transaction), params=rows)
     await session.commit()
 
     return {
@@ -116,34 +219,22 @@ async def ussd_endpoint(
     parts = [p for p in text_value.split("*") if p] if text_value else []
     level = len(parts)
 
+    # Initial dial: same prompt for everyone, so no database work is needed
+    if level == 0:
+        return WELCOME
+
     # Look up vendor by phone number
-    result = await session.exec(select(Vendor).where(Vendor.phone_number == phoneNumber))
-    vendor = result.first()
+    vendor = await get_vendor_cached(session, phoneNumber)
 
     # Scenario A: User NOT in Vendor table (KYC Flow)
     if vendor is None:
-        # Level 0: Welcome + ask full name
-        if level == 0:
-            return (
-                "CON Welcome to KulaPay Vendor!\n"
-                "To start selling, enter your Full Name:"
-            )
-
         # Level 1: got full name, ask business name
         if level == 1:
-            return (
-                "CON Great. What is your Business Name?\n"
-                "0. Back\n"
-                "00. Home"
-            )
+            return ASK_BIZ
 
         # Level 2: got business name, ask PIN
         if level == 2:
-            return (
-                "CON Set a 4-digit PIN to secure your wallet:\n"
-                "0. Back\n"
-                "00. Home"
-            )
+            return ASK_PIN
 
         # Level 3: got PIN, save Vendor to DB
         if level >= 3:
@@ -163,6 +254,7 @@ async def ussd_endpoint(
             )
             session.add(new_vendor)
             await session.commit()
+            _vendor_cache[phoneNumber] = new_vendor
 
             return (
                 f"END Account Created!\n"
@@ -174,10 +266,6 @@ async def ussd_endpoint(
         return "END Invalid input. Please dial again."
 
     # Scenario B: User IS in Vendor table (Dashboard Flow)
-    # Level 0: ask for PIN
-    if level == 0:
-        return f"CON Welcome back, {vendor.business_name}.\nEnter PIN:"
-
     # Level 1+: PIN entered
     entered_pin = parts[0].strip()
     if entered_pin != vendor.pin:
@@ -185,7 +273,7 @@ async def ussd_endpoint(
 
     # Level 1 and PIN OK -> show menu
     if level == 1:
-        return home_menu(vendor)
+        return HOME_MENU
 
     # Level 2 or more: user has selected a menu option
     selection = parts[1].strip()
@@ -196,7 +284,7 @@ async def ussd_endpoint(
         nav = parts[2].strip()
         if nav == "0":
             # Back to main dashboard menu
-            return home_menu(vendor)
+            return HOME_MENU
         if nav == "00":
             # "Home" here means restart login (ask for PIN again)
             return f"CON Welcome back, {vendor.business_name}.\nEnter PIN:"
@@ -212,11 +300,7 @@ async def ussd_endpoint(
 
         # Step 1: ask for customer name
         if level == 2:
-            return (
-                "CON Enter Customer Name:\n"
-                "0. Back\n"
-                "00. Home"
-            )
+            return RECORD_SALE_ASK_NAME
 
         # Extract fields that may be present
         customer_name = parts[2].strip() if level >= 3 else ""
@@ -226,19 +310,11 @@ async def ussd_endpoint(
 
         # Step 2: got name, ask phone
         if level == 3:
-            return (
-                "CON Enter Customer Phone:\n"
-                "0. Back\n"
-                "00. Home"
-            )
+            return RECORD_SALE_ASK_PHONE
 
         # Step 3: got phone, ask amount
         if level == 4:
-            return (
-                "CON Enter Amount (KES):\n"
-                "0. Back\n"
-                "00. Home"
-            )
+            return RECORD_SALE_ASK_AMOUNT
 
         # Step 4: got amount, ask food ordered
         if level == 5:
@@ -246,17 +322,9 @@ async def ussd_endpoint(
             try:
                 float(amount_str)
             except ValueError:
-                return (
-                    "CON Invalid amount. Enter Amount (KES):\n"
-                    "0. Back\n"
-                    "00. Home"
-                )
+                return RECORD_SALE_BAD_AMOUNT
 
-            return (
-                "CON What food was ordered?:\n"
-                "0. Back\n"
-                "00. Home"
-            )
+            return RECORD_SALE_ASK_FOOD
 
         # Step 5: got all fields, save transaction
         if level >= 6:
@@ -269,38 +337,34 @@ async def ussd_endpoint(
             tx = Transaction(
                 vendor_id=vendor.id,
                 amount=amount_val,
-                transaction_type="SALE",
+                transaction_type=TransactionType.SALE,
                 created_at=datetime.utcnow(),
             )
             session.add(tx)
             await session.commit()
 
-            return (
-                "CON Order successful.\n"
-                "0. Back\n"
-                "00. Home"
-            )
+            return RECORD_SALE_OK
 
         # Any other unexpected level in this branch
         return "END Invalid input. Please try again."
 
     # Option 2: Today's Stats
     if selection == "2":
-        # Compute today's window in UTC
-        today: date = datetime.utcnow().date()
-        start_dt = datetime.combine(today, time.min)
-        end_dt = datetime.combine(today, time.max)
-
-        tx_result = await session.exec(
-            select(Transaction)
+        # Today's window in UTC
+        _, start_dt, end_dt = _today_window()
+
+        # Aggregate in the database: one row back instead of every transaction
+        stats_result = await session.exec(
+            select(
+                func.coalesce(func.sum(Transaction.amount), 0.0),
+                func.count(Transaction.id),
+            )
             .where(Transaction.vendor_id == vendor.id)
+            .where(Transaction.transaction_type == TransactionType.SALE)
             .where(Transaction.created_at >= start_dt)
             .where(Transaction.created_at <= end_dt)
         )
-        tx_list = tx_result.all()
-
-        total_sales = sum(t.amount for t in tx_list if t.transaction_type == "SALE")
-        count = len([t for t in tx_list if t.transaction_type == "SALE"])
+        total_sales, count = stats_result.one()
 
         return (
             "CON Today's Pulse\n"
@@ -2,11 +2,13 @@
 Message handler for unified SMS/WhatsApp callback
 Processes KULA commands and manages transactions
 """
+from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.orm import Session
 from typing import Dict, Optional
 from models import Vendor, Customer, Transaction, PaymentType
-from services import award_points, check_credit_eligibility
+from services import award_points, check_credit_eligibility, invalidate_eligibility
 from messaging_service import messaging_service
+from at_utils import format_phone_number
 
 
 def process_kula_sale(
@@ -37,18 +39,26 @@ def process_kula_sale(
             'credit_eligible': bool
         }
     """
+    # One canonical (+254...) form so SMS, USSD and WhatsApp rows match
+    customer_phone = format_phone_number(customer_phone)
+    
     try:
-        # Get or create vendor
-        vendor = db.query(Vendor).filter(Vendor.phone_number == vendor_phone).first()
-        if not vendor:
+        # Fetch vendor and (possibly missing) customer in one round-trip
+        row = (
+            db.query(Vendor, Customer)
+            .outerjoin(Customer, Customer.phone_number == customer_phone)
+            .filter(Vendor.phone_number == vendor_phone)
+            .first()
+        )
+        if not row:
             return {
                 'success': False,
                 'message': f'Vendor {vendor_phone} not found. Please register first.',
                 'customer_phone': customer_phone
             }
+        vendor, customer = row
         
-        # Get or create customer
-        customer = db.query(Customer).filter(Customer.phone_number == customer_phone).first()
+        # Create customer on first sale
         if not customer:
             customer = Customer(
                 phone_number=customer_phone,
@@ -56,8 +66,6 @@ def process_kula_sale(
                 credit_limit=0.0
             )
             db.add(customer)
-            db.commit()
-            db.refresh(customer)
         
         # Create transaction (using CASH as default payment type for messaging)
         transaction = Transaction(
@@ -67,25 +75,24 @@ def process_kula_sale(
             payment_type=PaymentType.CASH
         )
         db.add(transaction)
-        db.commit()
         
-        # Award points
-        points_earned = award_points(customer_phone, amount, db)
+        # Award points and check credit eligibility in the same unit of work
+        points_earned = award_points(customer_phone, amount, db, commit=False, customer=customer)
+        eligibility = check_credit_eligibility(customer_phone, db, commit=False, customer=customer)
         
-        # Refresh customer to get updated points
-        db.refresh(customer)
+        # Read the new totals before commit expires them (no refresh SELECT needed)
+        total_points = customer.kula_points
+        credit_limit = customer.credit_limit
         
-        # Check credit eligibility
-        eligibility = check_credit_eligibility(customer_phone, db)
-        
-        # Refresh customer again to get updated credit limit
-        db.refresh(customer)
+        # Single commit for customer, transaction, points and credit limit
+        db.commit()
+        invalidate_eligibility(customer_phone)
         
         # Build response message
         response_message = (
             f"Sale Recorded! Customer {customer_phone} earned {points_earned:.2f} points. "
-            f"Total points: {customer.kula_points:.2f}. "
-            f"Credit Limit: {customer.credit_limit:.2f}."
+            f"Total points: {total_points:.2f}. "
+            f"Credit Limit: {credit_limit:.2f}."
         )
         
         if eligibility['eligible']:
@@ -96,12 +103,13 @@ def process_kula_sale(
             'message': response_message,
             'customer_phone': customer_phone,
             'points_earned': points_earned,
-            'total_points': customer.kula_points,
-            'credit_limit': customer.credit_limit,
+            'total_points': total_points,
+            'credit_limit': credit_limit,
             'credit_eligible': eligibility['eligible']
         }
     
-    except Exception as e:
+    except SQLAlchemyError as e:
+        db.rollback()
         return {
             'success': False,
             'message': f'Error processing sale: {str(e)}',
@@ -2,45 +2,47 @@
 Messaging Service for KulaPay
 Handles SMS and WhatsApp messaging via Africa's Talking
 """
-import os
-import requests
+import asyncio
+import httpx
 import re
-from typing import Dict, Optional, Tuple
-from dotenv import load_dotenv
+from typing import Dict, List, Optional, Tuple
+from at_utils import format_phone_number
+from config import get_settings
+from http_client import get_client
 
-load_dotenv()
-
-# Africa's Talking credentials
-AT_USERNAME = os.getenv("AT_USERNAME")
-AT_API_KEY = os.getenv("AT_API_KEY")
 AT_SMS_URL = "https://api.africastalking.com/version1/messaging"
 AT_WHATSAPP_URL = "https://api.africastalking.com/version1/whatsapp/message"
 
+# Max recipients per bulk SMS request
+SMS_BATCH_SIZE = 50
+
+# KULA [CustomerPhone] [Item] [Amount] - item may span several words;
+# amount is bounded (9 digits, 2 decimals) so float() can't overflow to inf
+_KULA_RE = re.compile(
+    r"^\s*KULA\s+(\+?\d{9,15})\s+(.+?)\s+(\d{1,9}(?:\.\d{1,2})?)\s*$",
+    re.IGNORECASE,
+)
+
 
 class MessagingService:
     """Unified messaging service for SMS and WhatsApp"""
     
-    def __init__(self):
-        self.username = AT_USERNAME
-        self.api_key = AT_API_KEY
+    @property
+    def username(self) -> Optional[str]:
+        return get_settings().at_username
+    
+    @property
+    def api_key(self) -> Optional[str]:
+        return get_settings().at_api_key
     
     def format_phone_number(self, phone: str) -> str:
         """
         Format phone number for Africa's Talking API
         Ensures phone number has country code (e.g., +254 for Kenya)
         """
-        phone = phone.strip().replace(" ", "").replace("-", "")
-        
-        if phone.startswith("+"):
-            return phone
-        if phone.startswith("0"):
-            return "+254" + phone[1:]
-        if phone.startswith("254"):
-            return "+" + phone
-        
-        return "+254" + phone
+        return format_phone_number(phone)
     
-    def send_sms(self, phone_number: str, message: str) -> Dict:
+    async def send_sms(self, phone_number: str, message: str) -> Dict:
         """
         Send SMS via Africa's Talking API
         
@@ -57,8 +59,51 @@ class MessagingService:
                 "error": "Africa's Talking credentials not configured"
             }
         
-        formatted_phone = self.format_phone_number(phone_number)
+        return await self._post_sms(self.format_phone_number(phone_number), message)
+    
+    async def send_sms_batch(self, items: List[Tuple[str, str]]) -> List[Dict]:
+        """
+        Send several SMS with as few API calls as possible
+        Recipients sharing a message body are sent in one request using
+        Africa's Talking's comma-separated "to" list.
+        
+        Args:
+            items: (phone_number, message) pairs
         
+        Returns:
+            list: API responses, one per request made
+        """
+        if not self.username or not self.api_key:
+            return [{
+                "success": False,
+                "error": "Africa's Talking credentials not configured"
+            }]
+        
+        # Group recipients by identical message body
+        recipients: Dict[str, List[str]] = {}
+        for phone_number, message in items:
+            recipients.setdefault(message, []).append(self.format_phone_number(phone_number))
+        
+        batches = [
+            (message, phones[i:i + SMS_BATCH_SIZE])
+            for message, phones in recipients.items()
+            for i in range(0, len(phones), SMS_BATCH_SIZE)
+        ]
+        results = await asyncio.gather(
+            *(self._send_sms_group(phones, message) for message, phones in batches)
+        )
+        return [result for group in results for result in group]
+    
+    async def _send_sms_group(self, phones: List[str], message: str) -> List[Dict]:
+        """Send one message to many recipients, one at a time if the batch fails"""
+        result = await self._post_sms(",".join(phones), message)
+        if result["success"] or len(phones) == 1:
+            return [result]
+        
+        return [await self._post_sms(phone, message) for phone in phones]
+    
+    async def _post_sms(self, to: str, message: str) -> Dict:
+        """POST to the SMS endpoint; `to` is one or more formatted numbers"""
         headers = {
             "ApiKey": self.api_key,
             "Content-Type": "application/x-www-form-urlencoded",
@@ -67,25 +112,25 @@ class MessagingService:
         
         data = {
             "username": self.username,
-            "to": formatted_phone,
+            "to": to,
             "message": message
         }
         
         try:
-            response = requests.post(AT_SMS_URL, headers=headers, data=data)
+            response = await get_client().post(AT_SMS_URL, headers=headers, data=data)
             response.raise_for_status()
             
             return {
                 "success": True,
                 "response": response.json()
             }
-        except requests.exceptions.RequestException as e:
+        except httpx.HTTPError as e:
             return {
                 "success": False,
                 "error": str(e)
             }
     
-    def send_whatsapp(self, phone_number: str, message: str) -> Dict:
+    async def send_whatsapp(self, phone_number: str, message: str) -> Dict:
         """
         Send WhatsApp message via Africa's Talking API
         
@@ -117,14 +162,14 @@ class MessagingService:
         }
         
         try:
-            response = requests.post(AT_WHATSAPP_URL, headers=headers, json=payload)
+            response = await get_client().post(AT_WHATSAPP_URL, headers=headers, json=payload)
             response.raise_for_status()
             
             return {
                 "success": True,
                 "response": response.json()
             }
-        except requests.exceptions.RequestException as e:
+        except httpx.HTTPError as e:
             return {
                 "success": False,
                 "error": str(e)
@@ -145,34 +190,16 @@ class MessagingService:
         if not text:
             return None, None, None, None
         
-        # Normalize text - remove extra spaces and convert to uppercase for command
-        text = text.strip()
-        
-        # Check if it starts with KULA (case insensitive)
-        if not text.upper().startswith("KULA"):
+        match = _KULA_RE.match(text)
+        if not match:
             return None, None, None, None
         
-        # Remove "KULA" prefix and split the rest
-        parts = text[4:].strip().split()
-        
-        if len(parts) < 3:
-            return None, None, None, None
-        
-        # Extract components
-        customer_phone = parts[0]
-        item = " ".join(parts[1:-1])  # Item name can have multiple words
-        amount_str = parts[-1]  # Last part should be the amount
-        
-        # Validate and parse amount
-        try:
-            amount = float(amount_str)
-            if amount <= 0:
-                return None, None, None, None
-        except ValueError:
-            return None, None, None, None
+        customer_phone, item, amount_str = match.groups()
+        # Collapse internal whitespace ("Chapati   Mix" -> "Chapati Mix")
+        item = " ".join(item.split())
         
-        # Validate phone number (basic check)
-        if len(customer_phone) < 9:
+        amount = float(amount_str)
+        if amount <= 0:
             return None, None, None, None
         
         return "KULA", customer_phone, item, amount
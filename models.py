@@ -7,6 +7,7 @@ from datetime import datetime
 from enum import Enum
 from typing import Optional
 
+from sqlalchemy import Column, Enum as SAEnum, Index
 from sqlmodel import Field, SQLModel
 
 
@@ -32,10 +33,26 @@ class Transaction(SQLModel, table=True):
     """Transaction for a vendor, used to power stats/dashboard."""
 
     id: Optional[int] = Field(default=None, primary_key=True)
-    vendor_id: int = Field(foreign_key="vendor.id", index=True)
+    vendor_id: int = Field(foreign_key="vendor.id")
     amount: float
-    transaction_type: str  # "SALE" or "CREDIT_PAYMENT"
+    # Native enum on PostgreSQL (4-byte OID instead of a varchar per row)
+    transaction_type: TransactionType = Field(
+        sa_column=Column(
+            SAEnum(
+                TransactionType,
+                name="transaction_type",
+                native_enum=True,
+                validate_strings=True,
+            ),
+            nullable=False,
+        )
+    )
     created_at: datetime = Field(default_factory=datetime.utcnow, nullable=False)
 
     # Simple FK-based link to Vendor via vendor_id; no ORM relationship required.
 
+
+# Covers the per-vendor date-range scans behind "Today's Stats" and
+# newest-first listings of a vendor's transactions; its vendor_id prefix also
+# serves plain lookups by vendor_id.
+Index("ix_tx_vendor_created_desc", Transaction.vendor_id, Transaction.created_at.desc())
@@ -2,10 +2,14 @@
 Business logic services for KulaPay
 Loyalty points, credit eligibility, and reward calculations
 """
+from cachetools import TTLCache
 from sqlalchemy.orm import Session
-from sqlalchemy import func
+from sqlalchemy import bindparam, case, func, insert, select, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from models import Customer, Transaction, PaymentType
-from typing import Tuple, Dict
+from at_utils import format_phone_number
+from typing import Tuple, Dict, List, Optional
 
 
 # Constants
@@ -15,9 +19,103 @@ MIN_TRANSACTIONS_FOR_CREDIT = 5
 MIN_SPEND_FOR_CREDIT = 500.0
 CREDIT_LIMIT_PERCENTAGE = 0.20  # 20% of total spend
 MAX_CREDIT_LIMIT = 300.0
+ELIGIBILITY_CACHE_TTL = 30  # seconds
 
+# Recent eligibility results per customer phone (per process)
+_eligibility_cache: TTLCache = TTLCache(maxsize=10_000, ttl=ELIGIBILITY_CACHE_TTL)
 
-def award_points(customer_phone: str, amount: float, db: Session) -> float:
+
+def invalidate_eligibility(customer_phone: str) -> None:
+    """
+    Drop the cached credit eligibility for a customer
+    Call after writing transactions that count towards eligibility.
+    """
+    _eligibility_cache.pop(customer_phone, None)
+
+
+def compute_points(amount: float) -> float:
+    """
+    KulaPoints earned for a sale amount (1 point per 10 KES)
+    """
+    return amount * POINTS_PER_KES
+
+
+def compute_eligibility(transaction_count: int, total_spend: float) -> Dict:
+    """
+    Derive credit eligibility from a customer's non-credit history
+    
+    Args:
+        transaction_count: Number of non-credit transactions
+        total_spend: Sum of non-credit transaction amounts in KES
+    
+    Returns:
+        dict: Same shape as check_credit_eligibility()
+    """
+    eligible = (
+        transaction_count >= MIN_TRANSACTIONS_FOR_CREDIT and
+        total_spend >= MIN_SPEND_FOR_CREDIT
+    )
+    
+    # Calculate credit limit: 20% of total spend, capped at 300 KES
+    if eligible:
+        credit_limit = min(total_spend * CREDIT_LIMIT_PERCENTAGE, MAX_CREDIT_LIMIT)
+        message = f"Available Credit: KES {credit_limit:.2f}"
+    else:
+        credit_limit = 0.0
+        remaining_transactions = max(0, MIN_TRANSACTIONS_FOR_CREDIT - transaction_count)
+        remaining_spend = max(0, MIN_SPEND_FOR_CREDIT - total_spend)
+        message = f"Keep buying to unlock credit. Need {remaining_transactions} more transactions and {remaining_spend:.2f} KES more."
+    
+    return {
+        'eligible': eligible,
+        'transaction_count': transaction_count,
+        'total_spend': total_spend,
+        'credit_limit': credit_limit,
+        'message': message
+    }
+
+
+# Customer id, points and non-credit spend for one phone, in a single query
+_SELECT_SALE_FOLLOWUP = select(
+    Customer.id,
+    Customer.kula_points,
+    func.count(Transaction.id),
+    func.coalesce(func.sum(Transaction.amount), 0.0)
+).outerjoin(
+    Transaction,
+    (Transaction.customer_phone == Customer.phone_number) &
+    (Transaction.payment_type != PaymentType.CREDIT)
+).where(
+    Customer.phone_number == bindparam("phone")
+).group_by(Customer.id)
+
+
+def get_sale_followup(customer_phone: str, db: Session) -> Tuple[Optional[int], float, int, float]:
+    """
+    Load a customer's points together with their eligibility inputs in one query
+    
+    Args:
+        customer_phone: Customer phone number
+        db: Database session
+    
+    Returns:
+        tuple: (customer id or None, kula points,
+                non-credit transaction count, non-credit total spend)
+    """
+    row = db.execute(_SELECT_SALE_FOLLOWUP, {"phone": customer_phone}).first()
+    
+    if row is None:
+        return None, 0.0, 0, 0.0
+    return tuple(row)
+
+
+def award_points(
+    customer_phone: str,
+    amount: float,
+    db: Session,
+    commit: bool = True,
+    customer: Optional[Customer] = None
+) -> float:
     """
     Award KulaPoints to a customer based on transaction amount
     Rule: 1 point for every 10 KES spent
@@ -26,19 +124,20 @@ def award_points(customer_phone: str, amount: float, db: Session) -> float:
         customer_phone: Customer phone number
         amount: Transaction amount in KES
         db: Database session
+        commit: Commit immediately; pass False when the caller commits the unit of work
+        customer: Already-loaded customer row, to skip the lookup by phone
     
     Returns:
         float: Points awarded
     """
-    points_earned = amount * POINTS_PER_KES
+    points_earned = compute_points(amount)
     
     # Get or create customer
-    customer = db.query(Customer).filter(Customer.phone_number == customer_phone).first()
+    if customer is None:
+        customer = db.query(Customer).filter(Customer.phone_number == customer_phone).first()
     
     if customer:
         customer.kula_points += points_earned
-        db.commit()
-        db.refresh(customer)
     else:
         # Customer should exist, but handle edge case
         customer = Customer(
@@ -47,13 +146,131 @@ def award_points(customer_phone: str, amount: float, db: Session) -> float:
             credit_limit=0.0
         )
         db.add(customer)
+    
+    if commit:
         db.commit()
-        db.refresh(customer)
+        # A committed sale changes eligibility inputs; with commit=False the
+        # caller invalidates after its own commit
+        invalidate_eligibility(customer_phone)
     
     return points_earned
 
 
-def check_credit_eligibility(customer_phone: str, db: Session) -> Dict:
+# Dialects with INSERT ... ON CONFLICT DO UPDATE support
+_UPSERT_INSERTS = {"postgresql": pg_insert, "sqlite": sqlite_insert}
+
+
+def upsert_customer_points(
+    customer_phone: str,
+    points: float,
+    credit_limit: Optional[float],
+    db: Session
+) -> Optional[float]:
+    """
+    Create the customer or add points to it in a single statement
+    Does not commit; the caller commits with the rest of the sale.
+    
+    Args:
+        customer_phone: Customer phone number
+        points: Points to add (initial balance for a new customer)
+        credit_limit: New credit limit, or None to leave it unchanged
+        db: Database session
+    
+    Returns:
+        float: The customer's new point total, or None if the database
+        has no ON CONFLICT upsert with RETURNING (caller writes via the ORM)
+    """
+    bind = db.get_bind()
+    dialect_insert = _UPSERT_INSERTS.get(bind.dialect.name)
+    if dialect_insert is None or not bind.dialect.insert_returning:
+        return None
+    
+    on_conflict = {Customer.kula_points: Customer.kula_points + points}
+    if credit_limit is not None:
+        on_conflict[Customer.credit_limit] = credit_limit
+    
+    stmt = dialect_insert(Customer).values(
+        phone_number=customer_phone,
+        kula_points=points,
+        credit_limit=credit_limit or 0.0
+    ).on_conflict_do_update(
+        index_elements=[Customer.phone_number],
+        set_=on_conflict
+    ).returning(Customer.kula_points)
+    
+    return float(db.execute(stmt).scalar_one())
+
+
+def record_sales_bulk(rows: List[Dict], db: Session) -> Dict[str, float]:
+    """
+    Record many sales at once with set-based statements and a single commit
+    Customers are created on first sale and awarded points like award_points.
+    
+    Args:
+        rows: Transaction dicts with vendor_id, customer_phone, amount, payment_type
+        db: Database session
+    
+    Returns:
+        dict: Points awarded per customer phone
+    """
+    if not rows:
+        return {}
+    
+    # Canonical (+254...) phones, as every channel stores them
+    rows = [
+        {**row, 'customer_phone': format_phone_number(row['customer_phone'])}
+        for row in rows
+    ]
+    
+    # Aggregate the points delta per customer
+    points_by_phone: Dict[str, float] = {}
+    for row in rows:
+        phone = row['customer_phone']
+        points_by_phone[phone] = points_by_phone.get(phone, 0.0) + compute_points(row['amount'])
+    
+    existing = {
+        phone for (phone,) in db.query(Customer.phone_number).filter(
+            Customer.phone_number.in_(points_by_phone)
+        )
+    }
+    
+    # New customers start with this batch's points
+    new_customers = [
+        {'phone_number': phone, 'kula_points': points, 'credit_limit': 0.0}
+        for phone, points in points_by_phone.items()
+        if phone not in existing
+    ]
+    if new_customers:
+        db.execute(insert(Customer), new_customers)
+    
+    # Existing customers: one UPDATE ... SET kula_points = kula_points + CASE phone_number ...
+    if existing:
+        db.execute(
+            update(Customer)
+            .where(Customer.phone_number.in_(existing))
+            .values(
+                kula_points=Customer.kula_points + case(
+                    {phone: points_by_phone[phone] for phone in existing},
+                    value=Customer.phone_number
+                )
+            )
+        )
+    
+    db.execute(insert(Transaction), rows)
+    db.commit()
+    
+    for phone in points_by_phone:
+        invalidate_eligibility(phone)
+    
+    return points_by_phone
+
+
+def check_credit_eligibility(
+    customer_phone: str,
+    db: Session,
+    commit: bool = True,
+    customer: Optional[Customer] = None
+) -> Dict:
     """
     Check if a customer is eligible for micro-credit (Eat Now, Pay Later)
     
@@ -64,6 +281,8 @@ def check_credit_eligibility(customer_phone: str, db: Session) -> Dict:
     Args:
         customer_phone: Customer phone number
         db: Database session
+        commit: Commit the credit limit update; pass False when the caller commits
+        customer: Already-loaded customer row, to skip the lookup by phone
     
     Returns:
         dict: {
@@ -74,49 +293,38 @@ def check_credit_eligibility(customer_phone: str, db: Session) -> Dict:
             'message': str
         }
     """
-    # Get customer's transaction history (excluding credit transactions)
-    transactions = db.query(Transaction).filter(
+    # Repeat checks within the TTL (e.g. credit menu then Accept Loan) skip the DB.
+    # Uncommitted callers must see their own pending sale, so they always query.
+    if commit:
+        cached = _eligibility_cache.get(customer_phone)
+        if cached is not None:
+            return cached
+    
+    # Count and total the customer's history in SQL (excluding credit transactions)
+    transaction_count, total_spend = db.query(
+        func.count(Transaction.id),
+        func.coalesce(func.sum(Transaction.amount), 0.0)
+    ).filter(
         Transaction.customer_phone == customer_phone,
         Transaction.payment_type != PaymentType.CREDIT
-    ).all()
+    ).one()
     
-    transaction_count = len(transactions)
-    total_spend = sum(t.amount for t in transactions)
-    
-    # Check eligibility
-    eligible = (
-        transaction_count >= MIN_TRANSACTIONS_FOR_CREDIT and
-        total_spend >= MIN_SPEND_FOR_CREDIT
-    )
-    
-    # Calculate credit limit: 20% of total spend, capped at 300 KES
-    if eligible:
-        credit_limit = min(total_spend * CREDIT_LIMIT_PERCENTAGE, MAX_CREDIT_LIMIT)
-    else:
-        credit_limit = 0.0
+    result = compute_eligibility(transaction_count, total_spend)
     
     # Update customer's credit limit if eligible
-    customer = db.query(Customer).filter(Customer.phone_number == customer_phone).first()
-    if customer and eligible:
-        customer.credit_limit = credit_limit
-        db.commit()
-        db.refresh(customer)
+    if result['eligible']:
+        if customer is None:
+            customer = db.query(Customer).filter(Customer.phone_number == customer_phone).first()
+        if customer:
+            customer.credit_limit = result['credit_limit']
+            if commit:
+                db.commit()
     
-    # Generate message
-    if eligible:
-        message = f"Available Credit: KES {credit_limit:.2f}"
-    else:
-        remaining_transactions = max(0, MIN_TRANSACTIONS_FOR_CREDIT - transaction_count)
-        remaining_spend = max(0, MIN_SPEND_FOR_CREDIT - total_spend)
-        message = f"Keep buying to unlock credit. Need {remaining_transactions} more transactions and {remaining_spend:.2f} KES more."
+    # Only cache committed state; uncommitted callers may still roll back
+    if commit:
+        _eligibility_cache[customer_phone] = result
     
-    return {
-        'eligible': eligible,
-        'transaction_count': transaction_count,
-        'total_spend': total_spend,
-        'credit_limit': credit_limit,
-        'message': message
-    }
+    return result
 
 
 def get_customer_points_info(customer_phone: str, db: Session) -> Dict:
@@ -169,22 +377,15 @@ def get_customer_transaction_stats(customer_phone: str, db: Session) -> Dict:
     Returns:
         dict: Transaction statistics
     """
-    # Get all non-credit transactions
-    transactions = db.query(Transaction).filter(
-        Transaction.customer_phone == customer_phone,
-        Transaction.payment_type != PaymentType.CREDIT
-    ).all()
-    
-    transaction_count = len(transactions)
-    total_spend = sum(t.amount for t in transactions)
-    
-    # Get credit transactions
-    credit_transactions = db.query(Transaction).filter(
-        Transaction.customer_phone == customer_phone,
-        Transaction.payment_type == PaymentType.CREDIT
-    ).all()
-    
-    credit_used = sum(t.amount for t in credit_transactions)
+    # Split spend and credit in one aggregate query
+    is_credit = Transaction.payment_type == PaymentType.CREDIT
+    transaction_count, total_spend, credit_used = db.query(
+        func.count(case((~is_credit, Transaction.id))),
+        func.coalesce(func.sum(case((~is_credit, Transaction.amount), else_=0.0)), 0.0),
+        func.coalesce(func.sum(case((is_credit, Transaction.amount), else_=0.0)), 0.0)
+    ).filter(
+        Transaction.customer_phone == customer_phone
+    ).one()
     
     return {
         'transaction_count': transaction_count,
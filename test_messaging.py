@@ -7,6 +7,11 @@ import json
 
 BASE_URL = "http://localhost:8000"
 
+# Reuse one keep-alive connection for every request in this script.
+# Content-Type is set by requests from data=/json=, so no per-call headers.
+SESSION = requests.Session()
+SESSION.headers.update({"Accept": "application/json"})
+
 
 def test_sms_callback():
     """Test SMS callback (form data)"""
@@ -20,12 +25,8 @@ def test_sms_callback():
         "text": "KULA 0711111111 Chapati 50"
     }
     
-    headers = {
-        "Content-Type": "application/x-www-form-urlencoded"
-    }
-    
     try:
-        response = requests.post(url, data=data, headers=headers)
+        response = SESSION.post(url, data=data)
         print(f"Status Code: {response.status_code}")
         print(f"Response: {json.dumps(response.json(), indent=2)}")
         print("-" * 50)
@@ -47,12 +48,8 @@ def test_whatsapp_callback():
         "text": "KULA 0711111111 Mandazi 30"
     }
     
-    headers = {
-        "Content-Type": "application/json"
-    }
-    
     try:
-        response = requests.post(url, json=payload, headers=headers)
+        response = SESSION.post(url, json=payload)
         print(f"Status Code: {response.status_code}")
         print(f"Response: {json.dumps(response.json(), indent=2)}")
         print("-" * 50)
@@ -75,7 +72,7 @@ def test_invalid_format():
     }
     
     try:
-        response = requests.post(url, data=data)
+        response = SESSION.post(url, data=data)
         print(f"Status Code: {response.status_code}")
         print(f"Response: {json.dumps(response.json(), indent=2)}")
         print("-" * 50)
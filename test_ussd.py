@@ -4,6 +4,9 @@ Run this to test the USSD endpoint locally
 """
 import requests
 
+# Reuse one keep-alive connection for every request in this script
+SESSION = requests.Session()
+
 # Test the USSD endpoint
 def test_ussd_root():
     """Test root menu (empty text)"""
@@ -15,7 +18,7 @@ def test_ussd_root():
         "text": ""
     }
     
-    response = requests.post(url, data=data)
+    response = SESSION.post(url, data=data)
     print(f"Root Menu Test:")
     print(f"Status: {response.status_code}")
     print(f"Response: {response.text}")
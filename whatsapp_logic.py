@@ -2,17 +2,132 @@
 WhatsApp chat logic for KulaPay
 Conversational interface (no numbering, more natural)
 """
-from typing import Optional
+import logging
+import re
+from typing import Final, List, Optional
+from cachetools import TTLCache
+from fastapi import BackgroundTasks
+from sqlalchemy import bindparam, select
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
 from sqlalchemy.orm import Session
 from models import Vendor, Customer, Transaction, PaymentType
-from services import award_points, check_credit_eligibility, get_customer_points_info
-from at_utils import repay_loan
+from services import (
+    check_credit_eligibility,
+    compute_eligibility,
+    compute_points,
+    get_customer_points_info,
+    get_sale_followup,
+    invalidate_eligibility,
+    upsert_customer_points,
+)
+from at_utils import format_phone_number, repay_loan
+
+logger = logging.getLogger(__name__)
+
+VENDOR_CACHE_TTL = 60  # seconds
+
+# Vendor ids by phone number (per process); a vendor's id never changes
+_vendor_id_cache: TTLCache = TTLCache(maxsize=10_000, ttl=VENDOR_CACHE_TTL)
+
+# Id lookups by phone number
+_SELECT_VENDOR_ID = select(Vendor.id).where(Vendor.phone_number == bindparam("phone"))
+_SELECT_CUSTOMER_ID = select(Customer.id).where(Customer.phone_number == bindparam("phone"))
+
+# Static replies
+_GREETING: Final[str] = (
+    "👋 Welcome to KulaPay!\n\n"
+    "I can help you with:\n"
+    "• New Sale - Process a customer purchase\n"
+    "• Check Points - View customer loyalty points\n"
+    "• Credit - Check credit eligibility\n\n"
+    "Just type what you'd like to do!"
+)
+
+_SALE_HELP: Final[str] = (
+    "💰 New Sale\n\n"
+    "Please send me:\n"
+    "1. Customer phone number\n"
+    "2. Amount\n"
+    "3. Payment type (Cash or M-Pesa)\n\n"
+    "Format: sale <phone> <amount> <cash|mpesa>\n"
+    "Example: sale 0712345678 500 cash"
+)
+
+_POINTS_HELP: Final[str] = (
+    "⭐ Check Points\n\n"
+    "Send me the customer phone number.\n"
+    "Format: points <phone>\n"
+    "Example: points 0712345678"
+)
+
+_CREDIT_HELP: Final[str] = (
+    "💳 Credit (Eat Now, Pay Later)\n\n"
+    "Send me the customer phone number to check eligibility.\n"
+    "Format: credit <phone>\n"
+    "Example: credit 0712345678"
+)
+
+_DEFAULT_HELP: Final[str] = (
+    "I didn't understand that. 😅\n\n"
+    "Try:\n"
+    "• 'sale' - Process a new sale\n"
+    "• 'points' - Check customer points\n"
+    "• 'credit' - Check credit eligibility\n"
+    "• 'help' - See all options"
+)
+
+_ERROR_REPLY: Final[str] = "❌ Something went wrong. Please try again."
+
+# Reply templates for the dynamic responses (filled with str.format_map)
+_SALE_OK_TMPL: Final[str] = (
+    "✅ Sale successful!\n\n"
+    "Amount: {amount} KES\n"
+    "Payment: {payment}\n"
+    "Points earned: {points:.2f}\n\n"
+    "Customer now has {total:.2f} total points."
+)
+
+_CREDIT_NUDGE_TMPL: Final[str] = "\n\n💳 Credit Eligible! Available: {limit:.2f} KES"
+
+_LOAN_OK_TMPL: Final[str] = (
+    "✅ Loan approved!\n\n"
+    "Amount: {amount:.2f} KES\n"
+    "Repayment will be processed via M-Pesa."
+)
+
+_CREDIT_OFFER_TMPL: Final[str] = (
+    "💳 {message}\n\n"
+    "To accept the loan, reply:\n"
+    "credit {phone} accept"
+)
+
+
+def _format_cents(cents: int) -> str:
+    """
+    Render a non-negative cent amount as "123.45" with integer arithmetic
+    """
+    whole, frac = divmod(cents, 100)
+    return f"{whole}.{frac:02d}"
+
+
+def _vendor_id(vendor_phone: str, db: Session) -> Optional[int]:
+    """
+    Resolve a vendor's id by phone, cached for VENDOR_CACHE_TTL seconds
+    Unknown numbers are not cached so a vendor who registers is seen at once.
+    """
+    vendor_id = _vendor_id_cache.get(vendor_phone)
+    if vendor_id is None:
+        vendor_id = db.execute(_SELECT_VENDOR_ID, {"phone": vendor_phone}).scalar()
+        if vendor_id is not None:
+            _vendor_id_cache[vendor_phone] = vendor_id
+    return vendor_id
 
 
 def handle_whatsapp_message(
     message: str,
     phone_number: str,
-    db: Session
+    db: Session,
+    background_tasks: Optional[BackgroundTasks] = None
 ) -> str:
     """
     Handle WhatsApp message - conversational interface
@@ -21,153 +136,161 @@ def handle_whatsapp_message(
         message: User's message (lowercased and stripped)
         phone_number: Vendor's phone number
         db: Database session
+        background_tasks: When given, side calls (loan repayment) run after the reply is sent
     
     Returns:
         str: Response message
     """
+    try:
+        return _dispatch(message, phone_number, db, background_tasks)
+    except Exception:
+        # Single catch-all for the channel: never leave the session dirty or the chat unanswered
+        db.rollback()
+        logger.exception("WhatsApp message from %s failed", phone_number)
+        return _ERROR_REPLY
+
+
+def _dispatch(
+    message: str,
+    phone_number: str,
+    db: Session,
+    background_tasks: Optional[BackgroundTasks]
+) -> str:
+    """
+    Route a WhatsApp message to a command or a canned reply
+    """
     message_lower = message.lower().strip()
+    # Lower-cased and split once; commands consume these tokens directly
+    tokens = message_lower.split(maxsplit=3)
     
-    # Greeting / Help
-    if message_lower in ["hi", "hello", "hey", "start", "help"]:
-        return (
-            "👋 Welcome to KulaPay!\n\n"
-            "I can help you with:\n"
-            "• New Sale - Process a customer purchase\n"
-            "• Check Points - View customer loyalty points\n"
-            "• Credit - Check credit eligibility\n\n"
-            "Just type what you'd like to do!"
-        )
+    # Commands: sale/points/credit <phone> ... ("credit check" etc. fall through to the hints)
+    if len(tokens) > 1 and _PHONE_TOKEN_RE.fullmatch(tokens[1]):
+        command = _COMMANDS.get(tokens[0])
+        if command:
+            return command(tokens, phone_number, db, background_tasks)
     
-    # New Sale
-    if "sale" in message_lower or "new sale" in message_lower or "sell" in message_lower:
-        return (
-            "💰 New Sale\n\n"
-            "Please send me:\n"
-            "1. Customer phone number\n"
-            "2. Amount\n"
-            "3. Payment type (Cash or M-Pesa)\n\n"
-            "Format: sale <phone> <amount> <cash|mpesa>\n"
-            "Example: sale 0712345678 500 cash"
-        )
-    
-    # Process sale command
-    if message_lower.startswith("sale "):
-        return process_sale_command(message, phone_number, db)
-    
-    # Check Points
-    if "points" in message_lower or "check points" in message_lower:
-        return (
-            "⭐ Check Points\n\n"
-            "Send me the customer phone number.\n"
-            "Format: points <phone>\n"
-            "Example: points 0712345678"
-        )
-    
-    # Process points command
-    if message_lower.startswith("points "):
-        return process_points_command(message, phone_number, db)
-    
-    # Credit
-    if "credit" in message_lower or "loan" in message_lower:
-        return (
-            "💳 Credit (Eat Now, Pay Later)\n\n"
-            "Send me the customer phone number to check eligibility.\n"
-            "Format: credit <phone>\n"
-            "Example: credit 0712345678"
-        )
+    # Greeting / Help
+    if message_lower in _GREETING_WORDS:
+        return _GREETING
     
-    # Process credit command
-    if message_lower.startswith("credit "):
-        return process_credit_command(message, phone_number, db)
+    # Keyword-style requests ("new sale", "check points", "loan") get a format hint
+    match = _KEYWORD_RE.search(message_lower)
+    if match:
+        return _KEYWORD_HELP[match.group(1)]
     
     # Default response
-    return (
-        "I didn't understand that. 😅\n\n"
-        "Try:\n"
-        "• 'sale' - Process a new sale\n"
-        "• 'points' - Check customer points\n"
-        "• 'credit' - Check credit eligibility\n"
-        "• 'help' - See all options"
-    )
+    return _DEFAULT_HELP
 
 
-def process_sale_command(message: str, vendor_phone: str, db: Session) -> str:
+def process_sale_command(
+    tokens: List[str],
+    vendor_phone: str,
+    db: Session,
+    background_tasks: Optional[BackgroundTasks] = None
+) -> str:
     """
     Process sale command: sale <phone> <amount> <cash|mpesa>
-    """
-    parts = message.split()
     
-    if len(parts) < 4:
+    Args:
+        tokens: Lower-cased message, split into at most 4 tokens
+        vendor_phone: Vendor's phone number
+        db: Database session
+    """
+    if len(tokens) < 4:
         return "❌ Invalid format. Use: sale <phone> <amount> <cash|mpesa>"
+    _, phone_str, amount_str, payment_str = tokens
+    
+    if not _AMOUNT_RE.fullmatch(amount_str):
+        return "❌ Invalid amount. Please use a number."
     
     try:
-        customer_phone = parts[1]
-        amount = float(parts[2])
-        payment_str = parts[3].lower()
-        
-        if amount <= 0:
+        customer_phone = format_phone_number(phone_str)
+        # Whole cents from here on; the float is derived once for the DB and services
+        amount_cents = int(round(float(amount_str) * 100))
+        amount = amount_cents / 100
+        if amount_cents <= 0:
             return "❌ Amount must be greater than 0"
         
-        if payment_str == "cash":
-            payment_type = PaymentType.CASH
-        elif payment_str in ["mpesa", "m-pesa", "m pesa"]:
-            payment_type = PaymentType.MPESA
-        else:
+        payment_type = _PAYMENT_MAP.get(payment_str)
+        if payment_type is None:
             return "❌ Payment type must be 'cash' or 'mpesa'"
         
-        # Get vendor
-        vendor = db.query(Vendor).filter(Vendor.phone_number == vendor_phone).first()
-        if not vendor:
+        vendor_id = _vendor_id(vendor_phone, db)
+        if vendor_id is None:
             return "❌ Vendor not found. Please register first."
         
-        # Get or create customer
-        customer = db.query(Customer).filter(Customer.phone_number == customer_phone).first()
-        if not customer:
-            customer = Customer(phone_number=customer_phone, kula_points=0.0, credit_limit=0.0)
-            db.add(customer)
-            db.commit()
-            db.refresh(customer)
+        # Customer points plus eligibility inputs in one round-trip; no further reads below
+        customer_id, kula_points, transaction_count, total_spend = get_sale_followup(customer_phone, db)
+        
+        # Points and eligibility from the loaded aggregates, counting this sale
+        points_earned = compute_points(amount)
+        eligibility = compute_eligibility(transaction_count + 1, total_spend + amount)
+        credit_limit = eligibility['credit_limit'] if eligibility['eligible'] else None
+        kula_points += points_earned
+        
+        # Create the customer or add the points in one upsert where supported
+        new_total = upsert_customer_points(customer_phone, points_earned, credit_limit, db)
+        if new_total is not None:
+            kula_points = new_total
+        elif customer_id is None:
+            # Create customer on first sale
+            db.add(Customer(
+                phone_number=customer_phone,
+                kula_points=kula_points,
+                credit_limit=credit_limit or 0.0
+            ))
+        else:
+            values = {Customer.kula_points: Customer.kula_points + points_earned}
+            if credit_limit is not None:
+                values[Customer.credit_limit] = credit_limit
+            db.query(Customer).filter(Customer.id == customer_id).update(
+                values, synchronize_session=False
+            )
         
         # Create transaction
-        transaction = Transaction(
-            vendor_id=vendor.id,
+        db.add(Transaction(
+            vendor_id=vendor_id,
             customer_phone=customer_phone,
             amount=amount,
             payment_type=payment_type
-        )
-        db.add(transaction)
-        db.commit()
-        
-        # Award points
-        points_earned = award_points(customer_phone, amount, db)
+        ))
         
-        # Check credit eligibility
-        eligibility = check_credit_eligibility(customer_phone, db)
+        # Single commit for customer, transaction, points and credit limit
+        db.commit()
+        invalidate_eligibility(customer_phone)
         
-        return (
-            f"✅ Sale successful!\n\n"
-            f"Amount: {amount:.2f} KES\n"
-            f"Payment: {payment_type.value}\n"
-            f"Points earned: {points_earned:.2f}\n\n"
-            f"Customer now has {customer.kula_points:.2f} total points."
-        )
+        reply = _SALE_OK_TMPL.format_map({
+            "amount": _format_cents(amount_cents),
+            "payment": _PAYMENT_LABEL[payment_type],
+            "points": points_earned,
+            "total": kula_points,
+        })
+        # Eligibility is already computed above; surfacing it costs no query
+        if credit_limit is not None:
+            reply += _CREDIT_NUDGE_TMPL.format_map({"limit": credit_limit})
+        return reply
         
-    except ValueError:
-        return "❌ Invalid amount. Please use a number."
-    except Exception as e:
-        return f"❌ Error processing sale: {str(e)}"
+    except IntegrityError:
+        db.rollback()
+        return "❌ Duplicate transaction, please retry."
+    except SQLAlchemyError:
+        db.rollback()
+        return "❌ Temporary DB issue, please retry."
 
 
-def process_points_command(message: str, vendor_phone: str, db: Session) -> str:
+def process_points_command(
+    tokens: List[str],
+    vendor_phone: str,
+    db: Session,
+    background_tasks: Optional[BackgroundTasks] = None
+) -> str:
     """
     Process points command: points <phone>
     """
-    parts = message.split()
-    
-    if len(parts) < 2:
+    if len(tokens) < 2:
         return "❌ Invalid format. Use: points <phone>"
     
-    customer_phone = parts[1]
+    customer_phone = format_phone_number(tokens[1])
     points_info = get_customer_points_info(customer_phone, db)
     
     if points_info['points'] == 0.0 and "not found" in points_info['message']:
@@ -176,38 +299,44 @@ def process_points_command(message: str, vendor_phone: str, db: Session) -> str:
     return f"⭐ {points_info['message']}"
 
 
-def process_credit_command(message: str, vendor_phone: str, db: Session) -> str:
+def process_credit_command(
+    tokens: List[str],
+    vendor_phone: str,
+    db: Session,
+    background_tasks: Optional[BackgroundTasks] = None
+) -> str:
     """
     Process credit command: credit <phone> [accept]
     """
-    parts = message.split()
-    
-    if len(parts) < 2:
+    if len(tokens) < 2:
         return "❌ Invalid format. Use: credit <phone>"
     
-    customer_phone = parts[1]
+    customer_phone = format_phone_number(tokens[1])
+    
+    # Loads the customer row itself only when it has a credit limit to update
     eligibility = check_credit_eligibility(customer_phone, db)
     
     if not eligibility['eligible']:
         return f"ℹ️ {eligibility['message']}"
     
     # If "accept" is in the message, process the loan
-    if len(parts) >= 3 and parts[2].lower() == "accept":
-        # Get vendor
-        vendor = db.query(Vendor).filter(Vendor.phone_number == vendor_phone).first()
-        if not vendor:
+    if len(tokens) >= 3 and tokens[2] == "accept":
+        vendor_id = _vendor_id(vendor_phone, db)
+        if vendor_id is None:
             return "❌ Vendor not found."
         
-        # Get customer
-        customer = db.query(Customer).filter(Customer.phone_number == customer_phone).first()
-        if not customer:
+        customer_exists = db.execute(
+            _SELECT_CUSTOMER_ID, {"phone": customer_phone}
+        ).scalar() is not None
+        if not customer_exists:
             return "❌ Customer not found."
         
-        loan_amount = customer.credit_limit
+        # Eligible customers carry the offered amount as their credit limit
+        loan_amount = eligibility['credit_limit']
         
         # Create credit transaction
         transaction = Transaction(
-            vendor_id=vendor.id,
+            vendor_id=vendor_id,
             customer_phone=customer_phone,
             amount=loan_amount,
             payment_type=PaymentType.CREDIT
@@ -215,19 +344,55 @@ def process_credit_command(message: str, vendor_phone: str, db: Session) -> str:
         db.add(transaction)
         db.commit()
         
-        # Mock loan repayment
-        repay_loan(customer_phone, loan_amount)
+        # Mock loan repayment, run after the reply is sent when possible
+        if background_tasks is not None:
+            background_tasks.add_task(repay_loan, customer_phone, loan_amount)
+        else:
+            repay_loan(customer_phone, loan_amount)
         
-        return (
-            f"✅ Loan approved!\n\n"
-            f"Amount: {loan_amount:.2f} KES\n"
-            f"Repayment will be processed via M-Pesa."
-        )
+        return _LOAN_OK_TMPL.format_map({"amount": loan_amount})
     
     # Show eligibility and instructions
-    return (
-        f"💳 {eligibility['message']}\n\n"
-        f"To accept the loan, reply:\n"
-        f"credit {customer_phone} accept"
-    )
+    return _CREDIT_OFFER_TMPL.format_map({
+        "message": eligibility['message'],
+        "phone": customer_phone,
+    })
+
+
+# Dispatch tables
+_GREETING_WORDS = frozenset({"hi", "hello", "hey", "start", "help"})
+
+_PAYMENT_MAP = {
+    "cash": PaymentType.CASH,
+    "mpesa": PaymentType.MPESA,
+    "m-pesa": PaymentType.MPESA,
+    "m pesa": PaymentType.MPESA,
+}
+
+# Display label per payment type, resolved once instead of per reply
+_PAYMENT_LABEL = {payment_type: payment_type.value for payment_type in PaymentType}
+
+_COMMANDS = {
+    "sale": process_sale_command,
+    "points": process_points_command,
+    "credit": process_credit_command,
+}
+
+# Plain decimal amounts ("500", "99.50"), at most 9 digits and 2 decimals so float()
+# and the cents conversion can't overflow. A sign is allowed so negatives get the
+# "greater than 0" reply.
+_AMOUNT_RE = re.compile(r"-?\d{1,9}(?:\.\d{1,2})?")
+
+# Customer phone argument, same shape the SMS KULA parser accepts
+_PHONE_TOKEN_RE = re.compile(r"\+?\d{9,15}")
+
+# Leading word boundary only, so "sales"/"selling"/"loans" still match
+_KEYWORD_RE = re.compile(r"\b(sale|sell|points|credit|loan)")
 
+_KEYWORD_HELP = {
+    "sale": _SALE_HELP,
+    "sell": _SALE_HELP,
+    "points": _POINTS_HELP,
+    "credit": _CREDIT_HELP,
+    "loan": _CREDIT_HELP,
+}